@@ -9,25 +9,37 @@ import json
 import glob
 import asyncio
 import logging
+import threading
+import time
 import hashlib
 import contextlib
-from typing import Any, Dict, List, Optional, Iterable
+import weakref
+from bisect import insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Iterable, Tuple
 from datetime import datetime, timedelta, date
 
 from dotenv import load_dotenv
-load_dotenv()  # loads .env from current working directory
+if not globals().get("_dotenv_loaded"):  # survive importlib.reload without re-reading .env
+    load_dotenv()  # loads .env from current working directory
+    _dotenv_loaded = True
 
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials as GoogleCredentials
 
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     BotCommand, BotCommandScopeDefault,
 )
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -46,8 +58,33 @@ GS_SUBS_SHEET = os.getenv("GS_SUBS_SHEET", "subs")
 TZ_NAME = os.getenv("TZ_NAME", "Europe/Samara")
 # groups (comma separated)
 GROUPS = [g.strip() for g in os.getenv("GROUPS", "10,11").split(",") if g.strip()]
-# watcher interval (seconds)
+_GROUPS_SET = frozenset(GROUPS)
+# label for "all groups" in broadcast texts
+_ALL_GROUPS_LABEL = "+".join(GROUPS)
+# watcher interval (seconds); doubles while nothing changes, up to WATCH_MAX_INTERVAL
 WATCH_INTERVAL = int(os.getenv("WATCH_INTERVAL", "60"))
+WATCH_MAX_INTERVAL = int(os.getenv("WATCH_MAX_INTERVAL", str(WATCH_INTERVAL * 8)))
+# change notifications wait NOTIFY_DEBOUNCE s after the last detected change,
+# but no longer than NOTIFY_DEBOUNCE_MAX s after the first one
+NOTIFY_DEBOUNCE = int(os.getenv("NOTIFY_DEBOUNCE", "60"))
+NOTIFY_DEBOUNCE_MAX = int(os.getenv("NOTIFY_DEBOUNCE_MAX", "300"))
+# FSM storage: Redis if configured (group choice survives restarts), else in-memory
+REDIS_URL = os.getenv("REDIS_URL")
+# worker threads for blocking Google Sheets calls
+GS_WORKERS = int(os.getenv("GS_WORKERS", "4"))
+# Telegram allows ~30 messages per second per bot; stay a bit below that
+BROADCAST_RATE = int(os.getenv("BROADCAST_RATE", "25"))
+# optional channel (bot must be able to post there): bulk sends are posted once
+# and copied to each recipient instead of sending the text every time
+LOG_CHANNEL_ID = os.getenv("LOG_CHANNEL_ID")
+# long-poll timeout for getUpdates (seconds); aiogram's default is 10
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
+# max age (seconds) of the schedule/exams data the handlers serve; independent of the
+# watcher's back-off, which only slows down change detection
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(WATCH_INTERVAL)))
+SUBS_CACHE_TTL = int(os.getenv("SUBS_CACHE_TTL", "60"))
+# watcher fingerprints survive restarts here (relative to the working directory, like .env)
+WATCH_STATE_PATH = os.getenv("WATCH_STATE_PATH", ".watch_state.json")
 
 # admins / superadmins env format: comma-separated integers
 ADMINS_RAW = os.getenv("ADMINS", "")
@@ -67,6 +104,9 @@ def parse_id_list(raw: str) -> set:
 
 ADMINS: set[int] = parse_id_list(ADMINS_RAW)
 SUPERADMINS: set[int] = parse_id_list(SUPERADMINS_RAW)
+# merged once so is_admin() is a single lookup
+_ALL_ADMINS: frozenset[int] = frozenset(ADMINS | SUPERADMINS)
+_SUPERS: frozenset[int] = frozenset(SUPERADMINS)
 
 # -------------------- Logging & TZ --------------------
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
@@ -90,6 +130,16 @@ except Exception:
     class _FakeTZ: pass
     tz = _FakeTZ()
 
+def make_fsm_storage():
+    if REDIS_URL:
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+            log.info("Using Redis FSM storage")
+            return RedisStorage.from_url(REDIS_URL)
+        except ImportError:
+            log.warning("REDIS_URL is set but the redis package is not installed. Falling back to memory storage.")
+    return MemoryStorage()
+
 def now_local() -> datetime:
     try:
         return datetime.now(tz)  # type: ignore[arg-type]
@@ -102,8 +152,9 @@ _GS_SCOPES = [
     "https://www.googleapis.com/auth/drive"
 ]
 
+@lru_cache(maxsize=1)
 def _load_service_account_credentials() -> Optional[GoogleCredentials]:
-    """Load credentials from a file path or JSON content (both from .env)."""
+    """Load credentials from a file path or JSON content (both from .env). Cached after first success."""
     try:
         if GOOGLE_CREDS_JSON_PATH and os.path.isfile(GOOGLE_CREDS_JSON_PATH):
             log.info("Loading Google credentials from file: %s", GOOGLE_CREDS_JSON_PATH)
@@ -118,9 +169,32 @@ def _load_service_account_credentials() -> Optional[GoogleCredentials]:
         log.exception("Failed to load Google service account credentials: %s", e)
         return None
 
+# authorized client, opened spreadsheet and worksheets are created once and reused
+_gs_client = None
+_gs_spreadsheet = None
+_ws_cache: Dict[str, Any] = {}
+_gs_lock = threading.RLock()
+
+def gs_reset():
+    """Drop cached gspread handles so the next call re-authorizes."""
+    global _gs_client, _gs_spreadsheet, _subs_headers_ok
+    with _gs_lock:
+        _gs_client = None
+        _gs_spreadsheet = None
+        _ws_cache.clear()
+        _subs_headers_ok = False
+
 def get_gspread_client():
+    global _gs_client
+    with _gs_lock:
+        if _gs_client is None:
+            _gs_client = _authorize_gspread_client()
+        return _gs_client
+
+def _authorize_gspread_client():
     creds = _load_service_account_credentials()
     if not creds:
+        _load_service_account_credentials.cache_clear()  # don't cache the failure
         raise RuntimeError("Google credentials not available. Check GOOGLE_CREDS_JSON_PATH or GOOGLE_CREDS_JSON_CONTENT.")
     try:
         client = gspread.authorize(creds)
@@ -136,22 +210,43 @@ def get_gspread_client():
         raise
 
 def sh_open():
+    global _gs_spreadsheet
     if not SPREADSHEET_ID or "PASTE_YOUR_SHEET_ID" in SPREADSHEET_ID:
         raise RuntimeError("Заполни SPREADSHEET_ID в .env (ID таблицы между /d/ и /edit в URL).")
-    client = get_gspread_client()
-    return client.open_by_key(SPREADSHEET_ID)
+    with _gs_lock:
+        if _gs_spreadsheet is None:
+            _gs_spreadsheet = get_gspread_client().open_by_key(SPREADSHEET_ID)
+        return _gs_spreadsheet
 
 def ws_open(sheet_name: str):
-    try:
-        return sh_open().worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
+    with _gs_lock:
+        ws = _ws_cache.get(sheet_name)
+        if ws is not None:
+            return ws
         sh = sh_open()
-        ws = sh.add_worksheet(title=sheet_name, rows=100, cols=10)
+        try:
+            ws = sh.worksheet(sheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            ws = sh.add_worksheet(title=sheet_name, rows=100, cols=10)
+        _ws_cache[sheet_name] = ws
         return ws
 
-def gs_read_all(sheet_name: str) -> List[Dict[str, Any]]:
-    ws = ws_open(sheet_name)
-    return ws.get_all_records()
+def gs_read_many(names: List[str]) -> Dict[str, List[List[str]]]:
+    """Read several sheets with one values.batchGet request: {sheet: rows}."""
+    # a missing tab would fail the whole batch; ws_open creates it (once, then cached)
+    for n in names:
+        ws_open(n)
+    resp = sh_open().values_batch_get(ranges=[absolute_range_name(n, "A:Z") for n in names])
+    ranges = resp.get("valueRanges", [])
+    return {n: vr.get("values", []) for n, vr in zip(names, ranges)}
+
+def values_to_records(values: List[List[str]]) -> List[Dict[str, Any]]:
+    """Header row + data rows -> list of dicts (same shape as ws.get_all_records)."""
+    if not values:
+        return []
+    header = [str(h).strip() for h in values[0]]
+    width = len(header)
+    return [dict(zip(header, list(row[:width]) + [""] * (width - len(row)))) for row in values[1:]]
 
 def gs_append_rows(sheet_name: str, rows: List[List[Any]]):
     if not rows:
@@ -159,34 +254,165 @@ def gs_append_rows(sheet_name: str, rows: List[List[Any]]):
     ws = ws_open(sheet_name)
     ws.append_rows(rows, value_input_option="RAW")
 
+def contiguous_runs(indices: Iterable[int]) -> List[Tuple[int, int]]:
+    """[5, 1, 2, 3, 7, 6] -> [(1, 3), (5, 7)]"""
+    runs = []
+    # consecutive values share the same (value - position) key
+    for _, grp in groupby(enumerate(sorted(set(indices))), lambda t: t[1] - t[0]):
+        run = [i for _, i in grp]
+        runs.append((run[0], run[-1]))
+    return runs
+
 def gs_clear_rows_by_indices(sheet_name: str, row_indices_desc: Iterable[int]):
+    """Delete 1-based rows with a single batch_update (one deleteDimension per contiguous run)."""
+    runs = contiguous_runs(row_indices_desc)
+    if not runs:
+        return
     ws = ws_open(sheet_name)
-    for idx in sorted(row_indices_desc, reverse=True):
-        ws.delete_rows(idx)
+    # bottom-up, so earlier deletions don't shift the indices of later ones
+    requests = [
+        {"deleteDimension": {"range": {
+            "sheetId": ws.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end,
+        }}}
+        for start, end in reversed(runs)
+    ]
+    sh_open().batch_update({"requests": requests})
+
+# set once the subs header row is verified; later calls are no-ops
+_subs_headers_ok = False
 
 def ensure_subs_sheet_headers():
+    global _subs_headers_ok
+    if _subs_headers_ok:
+        return
     ws = ws_open(GS_SUBS_SHEET)
     values = ws.get_all_values()
     want = ["user_id", "group", "added_at"]
     if not values:
         ws.update([want])
-        return
-    if values[0] != want:
+    elif values[0] != want:
         ws.update([want] + values[1:])
+    _subs_headers_ok = True
+
+# subs table kept in memory for SUBS_CACHE_TTL; the bot's own writes update it in place.
+# by_group: group -> sorted unique user ids, plus "both" for all groups together.
+_subs_cache: Dict[str, Any] = {"ts": 0.0, "loaded": False, "by_group": {}}
+
+def subs_cached() -> bool:
+    return _subs_cache["loaded"] and time.monotonic() - _subs_cache["ts"] < SUBS_CACHE_TTL
+
+def _parse_subs(rows: List[Dict[str, Any]]) -> List[Tuple[int, str]]:
+    """(user_id, group) for rows with a numeric user_id (the bot writes it that way); warn about the rest."""
+    subs = []
+    for r in rows:
+        try:
+            subs.append((int(str(r.get("user_id", "")).strip()), str(r.get("group"))))
+        except ValueError:
+            pass
+    if len(subs) < len(rows):
+        log.warning("Skipping %d malformed row(s) in sheet %s", len(rows) - len(subs), GS_SUBS_SHEET)
+    return subs
+
+def _index_subs(subs: List[Tuple[int, str]]) -> Dict[str, List[int]]:
+    # ids were converted once in _parse_subs; downstream code uses these ints
+    by_group: Dict[str, set] = {g: set() for g in GROUPS}
+    for uid, g in subs:
+        if g in by_group:
+            by_group[g].add(uid)
+    index = {g: sorted(uids) for g, uids in by_group.items()}
+    index["both"] = sorted(set().union(*by_group.values()))
+    return index
+
+def _store_subs(values: List[List[str]]):
+    subs = _parse_subs(values_to_records(values))
+    _subs_cache.update(ts=time.monotonic(), loaded=True, by_group=_index_subs(subs))
+
+def _load_subs():
+    _store_subs(gs_read_many([GS_SUBS_SHEET])[GS_SUBS_SHEET])
+
+def get_subs_by_group() -> Dict[str, List[int]]:
+    if not subs_cached():
+        _load_subs()
+    return _subs_cache["by_group"]
+
+def subs_row(uid: int, group: str) -> List[str]:
+    """Sheet row for a new subscription; user_id is always written as a plain numeric string."""
+    return [str(int(uid)), group, now_local().isoformat()]
+
+def subs_last_index() -> Dict[str, List[int]]:
+    """Last loaded index, even if expired (never triggers a read)."""
+    return _subs_cache["by_group"]
+
+def has_subscribers(index: Dict[str, List[int]]) -> bool:
+    return any(index.get(g) for g in GROUPS)
+
+def subs_add_cached(row: List[str]):
+    """Record a subscription the bot has just appended to the sheet."""
+    if not _subs_cache["loaded"]:
+        return  # invalidated meanwhile; the next load reads it from the sheet
+    uid, group = int(row[0]), row[1]
+    for key in (group, "both"):
+        uids = _subs_cache["by_group"].setdefault(key, [])
+        if uid not in uids:
+            insort(uids, uid)
+
+def subs_invalidate():
+    _subs_cache["loaded"] = False
 
 # -------------------- Data / formatting --------------------
+def row_key(kind: str, row: Dict[str, Any]) -> tuple:
+    """Canonical, hashable form of a row; used both as the pool key and the digest input."""
+    return (kind, tuple(sorted(row.items())))
+
+def row_digest(key: tuple) -> int:
+    # change detection only, no need for a cryptographic hash
+    blob = repr(key).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(blob, digest_size=16).digest(), "big")
+
+class Row(dict):
+    """Parsed, hash-consed sheet row: equal rows share one object that carries its digest."""
+    __slots__ = ("digest", "__weakref__")
+
+# rows stay pooled while some snapshot still references them
+_ROW_POOL: "weakref.WeakValueDictionary[tuple, Row]" = weakref.WeakValueDictionary()
+
+def intern_row(kind: str, item: Dict[str, Any]) -> Row:
+    key = row_key(kind, item)
+    row = _ROW_POOL.get(key)
+    if row is None:
+        row = Row(item)
+        row.digest = row_digest(key)
+        _ROW_POOL[key] = row
+    return row
+
 WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+_WEEKDAYS_SET = frozenset(WEEKDAYS)
 WEEKDAYS_RU = {
     "Mon": "Понедельник", "Tue": "Вторник", "Wed": "Среда",
     "Thu": "Четверг", "Fri": "Пятница", "Sat": "Суббота", "Sun": "Воскресенье"
 }
+# bold weekday headers, built once
+_WD_PREFIX = {wd: f"<b>{ru}" for wd, ru in WEEKDAYS_RU.items()}
 
 def monday_of_week(dt: datetime) -> datetime:
     d = dt
     return (d - timedelta(days=d.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
 
-def build_schedule_map(rows: List[Dict[str, Any]]) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
-    res: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+# (group, weekday) -> lessons sorted by start time
+ScheduleMap = Dict[Tuple[str, str], Tuple[Dict[str, Any], ...]]
+
+def start_minutes(s: str) -> int:
+    try:
+        # fixed-format "HH:MM-..." fast path; "H:MM-..." falls back to split
+        if s[2:3] == ":":
+            return int(s[0:2]) * 60 + int(s[3:5])
+        hh, mm = s.split("-", 1)[0].split(":", 1)
+        return int(hh) * 60 + int(mm)
+    except Exception:
+        return 0
+
+def build_schedule_map(rows: List[Dict[str, Any]]) -> ScheduleMap:
+    res: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
     for r in rows:
         g = str(r.get("group", "")).strip()
         wd = str(r.get("weekday", "")).strip()
@@ -194,39 +420,44 @@ def build_schedule_map(rows: List[Dict[str, Any]]) -> Dict[str, Dict[str, List[D
         subj = str(r.get("subject", "")).strip()
         teacher = str(r.get("teacher", "")).strip()
         room = str(r.get("room", "")).strip()
-        if g in GROUPS and wd in WEEKDAYS and tm and subj:
-            item = {"time": tm, "subject": subj}
+        if g in _GROUPS_SET and wd in _WEEKDAYS_SET and tm and subj:
+            # _m: start minute, precomputed once for sorting
+            item = {"time": tm, "subject": subj, "_m": start_minutes(tm)}
             if teacher:
                 item["teacher"] = teacher
             if room:
                 item["room"] = room
-            res.setdefault(g, {}).setdefault(wd, []).append(item)
-
-    def start_minutes(s: str) -> int:
-        try:
-            hh, mm = s.split("-")[0].split(":")
-            return int(hh) * 60 + int(mm)
-        except Exception:
-            return 0
+            res.setdefault((g, wd), []).append(intern_row(wd, item))
+    by_start = itemgetter("_m")
+    return {key: tuple(sorted(items, key=by_start)) for key, items in res.items()}
 
-    for g, days in res.items():
-        for wd, items in days.items():
-            items.sort(key=lambda x: start_minutes(x["time"]))
-    return res
+# Parsed snapshots, swapped by refresh_all() (watchdog polls and handler refreshes alike).
+# Handlers refresh them on demand once they are older than CACHE_TTL.
+_SCHEDULE_SNAPSHOT: Optional[ScheduleMap] = None
+_EXAMS_SNAPSHOT: Optional[Dict[str, List[Dict[str, Any]]]] = None
+_SNAPSHOT_TS = 0.0
 
-def read_schedule_map() -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
-    return build_schedule_map(gs_read_all(GS_SCHEDULE_SHEET))
+def read_schedule_map() -> ScheduleMap:
+    snap = _SCHEDULE_SNAPSHOT
+    return snap if snap is not None else refresh_all()[0]
 
+@lru_cache(maxsize=4096)
 def parse_exam_date(ds: str) -> Optional[date]:
     """
     Parse exam date from Google Sheet.
     Accepts: YYYY-MM-DD, DD.MM.YYYY (and a few common variations), ISO strings.
-    Returns a date or None.
+    Returns a date or None. Memoized: the same cells are re-read on every refresh.
     """
     s = (ds or "").strip()
     if not s:
         return None
+    # Fast path for ISO dates
+    try:
+        return date.fromisoformat(s)
+    except ValueError:
+        pass
     # Common formats
+    # %Y-%m-%d again: unlike fromisoformat it also accepts unpadded dates like 2024-3-5
     for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%d.%m.%y", "%Y/%m/%d", "%d/%m/%Y", "%d-%m-%Y", "%Y.%m.%d"):
         try:
             return datetime.strptime(s, fmt).date()
@@ -239,7 +470,10 @@ def parse_exam_date(ds: str) -> Optional[date]:
         return None
 
 def read_exams_map() -> Dict[str, List[Dict[str, Any]]]:
-    rows = gs_read_all(GS_EXAMS_SHEET)
+    snap = _EXAMS_SNAPSHOT
+    return snap if snap is not None else refresh_all()[1]
+
+def build_exams_map(rows: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
     res: Dict[str, List[Dict[str, Any]]] = {}
     for r in rows:
         g = str(r.get("group", "")).strip()
@@ -247,62 +481,71 @@ def read_exams_map() -> Dict[str, List[Dict[str, Any]]]:
         tm = str(r.get("time", "")).strip()
         subj = str(r.get("subject", "")).strip()
         note = str(r.get("note", "")).strip()
-        if g in GROUPS and ds and subj:
+        if g in _GROUPS_SET and ds and subj:
             d = parse_exam_date(ds)
             if not d:
                 continue
-            # Keep both: human-readable for UI and ISO for sorting/filtering/hash stability
-            res.setdefault(g, []).append({
-                "date": d.strftime("%d.%m.%Y"),
-                "date_iso": d.isoformat(),
+            # date object for sorting/filtering, preformatted string for UI
+            res.setdefault(g, []).append(intern_row("exam", {
+                "date": d,
+                "date_str": d.strftime("%d.%m.%Y"),
                 "time": tm,
                 "subject": subj,
                 "note": note
-            })
+            }))
     for g in res:
-        res[g].sort(key=lambda x: (x.get("date_iso", ""), x.get("time", "")))
+        res[g].sort(key=lambda x: (x["date"], x.get("time", "")))
     return res
 
+def refresh_all():
+    """Fetch schedule, exams and subs in one request, parse them and swap the snapshots."""
+    global _SCHEDULE_SNAPSHOT, _EXAMS_SNAPSHOT, _SNAPSHOT_TS
+    raw = gs_read_many([GS_SCHEDULE_SHEET, GS_EXAMS_SHEET, GS_SUBS_SHEET])
+    sched_rows = values_to_records(raw.get(GS_SCHEDULE_SHEET, []))
+    exams_rows = values_to_records(raw.get(GS_EXAMS_SHEET, []))
+    sched = build_schedule_map(sched_rows)
+    exams = build_exams_map(exams_rows)
+    _SCHEDULE_SNAPSHOT, _EXAMS_SNAPSHOT, _SNAPSHOT_TS = sched, exams, time.monotonic()
+    _store_subs(raw.get(GS_SUBS_SHEET, []))
+    return sched, exams
+
+def reload_all():
+    """Re-authorize, drop caches and re-read everything (blocking; run via _gs)."""
+    gs_reset()
+    subs_invalidate()
+    return refresh_all()
+
 
 def format_lessons(lessons: List[Dict[str, Any]]) -> str:
     if not lessons:
         return "Пар нет 🎉"
     out = []
     for i, x in enumerate(lessons, start=1):
-        extra = []
-        if x.get("teacher"):
-            extra.append(x["teacher"])
-        if x.get("room"):
-            extra.append(f"ауд. {x['room']}")
-        tail = f" ({', '.join(extra)})" if extra else ""
+        teacher = x.get("teacher")
+        room = x.get("room")
+        if teacher and room:
+            tail = f" ({teacher}, ауд. {room})"
+        elif teacher:
+            tail = f" ({teacher})"
+        elif room:
+            tail = f" (ауд. {room})"
+        else:
+            tail = ""
         out.append(f"{i}. {x['time']} — {x['subject']}{tail}")
     return "\n".join(out)
 
 def exams_for_range(exams: List[Dict[str, Any]], start: date, end: date) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
-    for x in exams:
-        # Prefer ISO for reliable parsing/sorting, but accept "DD.MM.YYYY" too
-        d = parse_exam_date(str(x.get("date_iso") or x.get("date") or ""))
-        if not d:
-            continue
-        if start <= d <= end:
-            y = dict(x)
-            y.setdefault("date_iso", d.isoformat())
-            y.setdefault("date", d.strftime("%d.%m.%Y"))
-            out.append(y)
-    return sorted(out, key=lambda x: (x.get("date_iso", ""), x.get("time", "")))
+    # x["date"] is already a date object (see build_exams_map)
+    out = [x for x in exams if start <= x["date"] <= end]
+    return sorted(out, key=lambda x: (x["date"], x.get("time", "")))
 
 
 def week_range_str(monday: date) -> str:
     return f"{monday:%d.%m}–{(monday + timedelta(days=6)):%d.%m}"
 
 # -------------------- Keyboards --------------------
-def groups_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=g, callback_data=f"pick_group:{g}") for g in GROUPS]
-    ])
-
-def main_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+# Markups are immutable for the bot's lifetime: build once at import, return the same objects.
+def _build_main_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="Сегодня", callback_data="menu:today"),
          InlineKeyboardButton(text="Завтра", callback_data="menu:tomorrow")],
@@ -317,21 +560,42 @@ def main_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton(text="⚙️ Админ-панель", callback_data="admin:panel")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+_GROUPS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=g, callback_data=f"pick_group:{g}") for g in GROUPS]
+])
+_MAIN_MENU_KB_ADMIN = _build_main_menu_kb(True)
+_MAIN_MENU_KB_USER = _build_main_menu_kb(False)
+_ADMIN_PANEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="ℹ️ Инфо", callback_data="admin:info"),
+     InlineKeyboardButton(text="🔄 Reload", callback_data="admin:reload")],
+    [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")],
+])
+_BROADCAST_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="10 класс", callback_data="broadcast:grp:10"),
+     InlineKeyboardButton(text="11 класс", callback_data="broadcast:grp:11")],
+    [InlineKeyboardButton(text="10+11", callback_data="broadcast:grp:both")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast:cancel")],
+])
+_SUBS_ADD_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=g + " класс", callback_data=f"subs:add:{g}") for g in GROUPS]
+])
+_SUBS_DEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=g + " класс", callback_data=f"subs:del:{g}") for g in GROUPS],
+    [InlineKeyboardButton(text="От всего", callback_data="subs:del:all")],
+])
+
+def groups_kb() -> InlineKeyboardMarkup:
+    return _GROUPS_KB
+
+def main_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+    return _MAIN_MENU_KB_ADMIN if is_admin_user else _MAIN_MENU_KB_USER
+
 def admin_panel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ℹ️ Инфо", callback_data="admin:info"),
-         InlineKeyboardButton(text="🔄 Reload", callback_data="admin:reload")],
-        [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")],
-    ])
+    return _ADMIN_PANEL_KB
 
 def broadcast_pick_group_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="10 класс", callback_data="broadcast:grp:10"),
-         InlineKeyboardButton(text="11 класс", callback_data="broadcast:grp:11")],
-        [InlineKeyboardButton(text="10+11", callback_data="broadcast:grp:both")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast:cancel")],
-    ])
+    return _BROADCAST_KB
 
 # -------------------- FSM --------------------
 class Form(StatesGroup):
@@ -343,10 +607,13 @@ class BroadcastFSM(StatesGroup):
 
 # -------------------- Helpers --------------------
 def is_admin(uid: int) -> bool:
-    return uid in ADMINS or uid in SUPERADMINS
+    return uid in _ALL_ADMINS
 
 def is_superadmin(uid: int) -> bool:
-    return uid in SUPERADMINS
+    return uid in _SUPERS
+
+# callback toast shown when the handler has to go to Google Sheets first
+LOADING_TEXT = "Загружаю..."
 
 async def ack(cq: CallbackQuery, text: Optional[str] = None):
     try:
@@ -365,50 +632,169 @@ async def ensure_group(m: Message | CallbackQuery, state: FSMContext) -> Optiona
         return None
     return group
 
+# dedicated pool: bounds concurrent Sheets requests and keeps them off the default executor
+_gs_executor = ThreadPoolExecutor(max_workers=GS_WORKERS, thread_name_prefix="gsheets")
+
+async def _gs(fn, *args, **kwargs):
+    """Run a blocking gspread call in a worker thread so the event loop stays responsive."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_gs_executor, partial(fn, *args, **kwargs))
+
+def snapshots_ready() -> bool:
+    return _have_snapshots() and time.monotonic() - _SNAPSHOT_TS < CACHE_TTL
+
+def _have_snapshots() -> bool:
+    return _SCHEDULE_SNAPSHOT is not None and _EXAMS_SNAPSHOT is not None
+
+# one handler-triggered refresh at a time; requests waiting on it reuse its result
+_snapshot_lock = asyncio.Lock()
+_snapshot_attempts = 0
+
+async def ensure_snapshots():
+    """Refresh expired snapshots (single-flight). On failure keep serving the old ones, if any."""
+    global _snapshot_attempts
+    if snapshots_ready():
+        return
+    seen = _snapshot_attempts
+    async with _snapshot_lock:
+        # refreshed while we waited, or the attempt failed but there is something to serve
+        if snapshots_ready() or (_snapshot_attempts != seen and _have_snapshots()):
+            return
+        try:
+            await _gs(refresh_all)
+        except Exception as e:
+            if not _have_snapshots():
+                raise
+            log.warning("Snapshot refresh failed, serving the previous one: %r", e)
+        finally:
+            _snapshot_attempts += 1  # counted on completion: only requests that waited reuse it
+
+class RateLimiter:
+    """At most `rate` acquisitions per `per` seconds (sliding window); waiters go in FIFO order."""
+
+    def __init__(self, rate: int, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self._stamps: deque = deque()
+        self._lock = asyncio.Lock()
+        self._resume_at = 0.0
+
+    def pause(self, seconds: float):
+        """Hold every waiter for `seconds` (e.g. after Telegram's RetryAfter)."""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            while self._stamps and now - self._stamps[0] >= self.per:
+                self._stamps.popleft()
+            if len(self._stamps) >= self.rate:
+                await asyncio.sleep(self.per - (now - self._stamps[0]))
+                self._stamps.popleft()
+            self._stamps.append(time.monotonic())
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+# Sends to users (broadcasts and change notifications): bounded concurrency + shared rate limit
+_send_concurrency = asyncio.Semaphore(BROADCAST_RATE)
+_send_rate = RateLimiter(BROADCAST_RATE, per=1.0)
+
+async def _broadcast_send(bot: Bot, uid: int, text: str, source: Optional[Message] = None,
+                          link_preview: bool = False, attempts: int = 3) -> bool:
+    async with _send_concurrency:
+        for _ in range(attempts):
+            await _send_rate.acquire()
+            try:
+                if source is not None:
+                    await bot.copy_message(uid, source.chat.id, source.message_id)
+                else:
+                    await bot.send_message(uid, text, disable_web_page_preview=not link_preview)
+                return True
+            except TelegramRetryAfter as e:
+                # the flood limit is per bot: pause all sends, not just this one
+                log.warning("Flood limit on %s, retry in %ss", uid, e.retry_after)
+                _send_rate.pause(e.retry_after)
+            except Exception as e:
+                log.warning("Не удалось отправить %s: %r", uid, e)
+                return False
+        return False
+
+async def send_many(bot: Bot, targets: Iterable[int], text: str,
+                    link_preview: bool = False) -> tuple[int, int]:
+    """Send `text` to all targets concurrently within Telegram limits. Returns (ok, fail).
+
+    Link previews are off by default: bulk texts only carry bot commands, and a preview
+    would be fetched for every recipient.
+    """
+    source = None
+    if LOG_CHANNEL_ID:
+        # post once, then copy: recipients get an identical message without re-sending the text
+        try:
+            await _send_rate.acquire()
+            # copies keep the original's preview setting
+            source = await bot.send_message(LOG_CHANNEL_ID, text,
+                                            disable_web_page_preview=not link_preview)
+        except Exception as e:
+            log.warning("Не удалось отправить в LOG_CHANNEL_ID, рассылаю напрямую: %r", e)
+    results = await asyncio.gather(*(_broadcast_send(bot, uid, text, source, link_preview)
+                                     for uid in targets),
+                                   return_exceptions=True)
+    ok = sum(1 for r in results if r is True)
+    return ok, len(results) - ok
+
 # -------------------- Router / Handlers --------------------
 router = Router()
 
+# callback filters, built once and shared with the handlers below
+SUBS_ADD_CB = F.data.startswith("subs:add:")
+SUBS_DEL_CB = F.data.startswith("subs:del:")
+PICK_GROUP_CB = F.data.startswith("pick_group:")
+MENU_CB = F.data.startswith("menu:")
+BROADCAST_CB = F.data.startswith("broadcast:")
+ADMIN_CB = F.data.startswith("admin:")
+
 # Subscriptions
 @router.message(Command("subscribe"))
 async def cmd_subscribe(m: Message, state: FSMContext):
-    await m.answer(
-        "Выберите группу для подписки на уведомления:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=g + " класс", callback_data=f"subs:add:{g}") for g in GROUPS]
-        ])
-    )
+    await m.answer("Выберите группу для подписки на уведомления:", reply_markup=_SUBS_ADD_KB)
 
 @router.message(Command("unsubscribe"))
 async def cmd_unsubscribe(m: Message, state: FSMContext):
-    buttons = [[InlineKeyboardButton(text=g + " класс", callback_data=f"subs:del:{g}") for g in GROUPS]]
-    buttons.append([InlineKeyboardButton(text="От всего", callback_data="subs:del:all")])
-    await m.answer("От какой группы отписаться?", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await m.answer("От какой группы отписаться?", reply_markup=_SUBS_DEL_KB)
 
-@router.callback_query(F.data.startswith("subs:add:"))
+@router.callback_query(SUBS_ADD_CB)
 async def on_subs_add(cq: CallbackQuery):
-    await ack(cq)
+    await ack(cq, None if subs_cached() else LOADING_TEXT)
     group = cq.data.split(":")[2]
     if group not in GROUPS:
         await cq.message.answer("Некорректная группа.")
         return
-    ensure_subs_sheet_headers()
-    ws = ws_open(GS_SUBS_SHEET)
-    rows = ws.get_all_records()
-    for r in rows:
-        if str(r.get("user_id")) == str(cq.from_user.id) and str(r.get("group")) == group:
-            await cq.message.answer(f"Вы уже подписаны на {group} класс.")
-            break
+    # header first: a header-less sheet would turn the new row into the header
+    await _gs(ensure_subs_sheet_headers)
+    subs_by_group = await _gs(get_subs_by_group)
+    if cq.from_user.id in subs_by_group.get(group, ()):
+        await cq.message.answer(f"Вы уже подписаны на {group} класс.")
     else:
-        gs_append_rows(GS_SUBS_SHEET, [[str(cq.from_user.id), group, now_local().isoformat()]])
+        row = subs_row(cq.from_user.id, group)
+        await _gs(gs_append_rows, GS_SUBS_SHEET, [row])
+        subs_add_cached(row)
         await cq.message.answer(f"Готово! Подписка на уведомления группы {group} оформлена.")
 
-@router.callback_query(F.data.startswith("subs:del:"))
+@router.callback_query(SUBS_DEL_CB)
 async def on_subs_del(cq: CallbackQuery):
-    await ack(cq)
+    await ack(cq, LOADING_TEXT)
     which = cq.data.split(":")[2]
-    ensure_subs_sheet_headers()
-    ws = ws_open(GS_SUBS_SHEET)
-    values = ws.get_all_values()
+    await _gs(ensure_subs_sheet_headers)
+    ws = await _gs(ws_open, GS_SUBS_SHEET)
+    values = await _gs(ws.get_all_values)
     to_delete = []
     for idx, row in enumerate(values, start=1):
         if idx == 1:
@@ -421,7 +807,8 @@ async def on_subs_del(cq: CallbackQuery):
     if not to_delete:
         await cq.message.answer("Нечего удалять — вы не подписаны.")
     else:
-        gs_clear_rows_by_indices(GS_SUBS_SHEET, to_delete)
+        await _gs(gs_clear_rows_by_indices, GS_SUBS_SHEET, to_delete)
+        subs_invalidate()
         await cq.message.answer("Подписка удалена." if which != "all" else "Все подписки удалены.")
 
 # Start / group
@@ -439,7 +826,7 @@ async def cmd_group(m: Message, state: FSMContext):
     await state.clear()
     await m.answer("Выберите группу:", reply_markup=groups_kb())
 
-@router.callback_query(F.data.startswith("pick_group:"))
+@router.callback_query(PICK_GROUP_CB)
 async def on_pick_group(cq: CallbackQuery, state: FSMContext):
     await ack(cq)
     group = cq.data.split(":")[1]
@@ -454,93 +841,26 @@ async def on_pick_group(cq: CallbackQuery, state: FSMContext):
         reply_markup=main_menu_kb(admin_flag)
     )
 
-# Schedule commands
-@router.message(Command("today"))
-async def cmd_today(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
-    sched = read_schedule_map()
-    dt = now_local()
-    wd = WEEKDAYS[dt.weekday()]
-    items = sched.get(group, {}).get(wd, [])
-    await m.answer(
-        f"<b>{WEEKDAYS_RU[wd]} ({dt:%d.%m.%Y})</b>\n{format_lessons(items)}",
-        parse_mode="HTML",
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
-
-@router.message(Command("tomorrow"))
-async def cmd_tomorrow(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
-    sched = read_schedule_map()
-    dt = now_local() + timedelta(days=1)
+# Schedule / exams views, shared by commands and menu callbacks
+def render_date(group: str, dt: datetime) -> str:
     wd = WEEKDAYS[dt.weekday()]
-    items = sched.get(group, {}).get(wd, [])
-    await m.answer(
-        f"<b>{WEEKDAYS_RU[wd]} ({dt:%d.%m.%Y})</b>\n{format_lessons(items)}",
-        parse_mode="HTML",
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
+    items = read_schedule_map().get((group, wd), ())
+    return "".join((_WD_PREFIX[wd], " (", dt.strftime("%d.%m.%Y"), ")</b>\n", format_lessons(items)))
 
-@router.message(Command("week"))
-async def cmd_week(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
-    sched = read_schedule_map()
-    start = monday_of_week(now_local())
-    chunks = []
-    d = start
-    for _ in range(7):
-        wd = WEEKDAYS[d.weekday()]
-        items = sched.get(group, {}).get(wd, [])
-        chunks.append(f"<b>{WEEKDAYS_RU[wd]} ({d:%d.%m})</b>\n{format_lessons(items)}")
-        d += timedelta(days=1)
-    await m.answer("\n\n".join(chunks), parse_mode="HTML", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
+def _render_day(group: str, offset: int) -> str:
+    return render_date(group, now_local() + timedelta(days=offset))
 
-@router.message(Command("nextweek"))
-async def cmd_nextweek(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
+def _render_week(group: str, week_offset: int) -> str:
     sched = read_schedule_map()
-    start = monday_of_week(now_local()) + timedelta(days=7)
+    d = monday_of_week(now_local()) + timedelta(days=7 * week_offset)
     chunks = []
-    d = start
     for _ in range(7):
         wd = WEEKDAYS[d.weekday()]
-        items = sched.get(group, {}).get(wd, [])
-        chunks.append(f"<b>{WEEKDAYS_RU[wd]} ({d:%d.%m})</b>\n{format_lessons(items)}")
+        items = sched.get((group, wd), ())
+        chunks.append("".join((_WD_PREFIX[wd], " (", d.strftime("%d.%m"), ")</b>\n", format_lessons(items))))
         d += timedelta(days=1)
-    await m.answer("\n\n".join(chunks), parse_mode="HTML", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
+    return "\n\n".join(chunks)
 
-@router.message(Command("date"))
-async def cmd_date(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
-    parts = (m.text or "").split()
-    if len(parts) != 2:
-        await m.answer("Использование: /date YYYY-MM-DD")
-        return
-    try:
-        dt = datetime.strptime(parts[1], "%Y-%m-%d")
-    except ValueError:
-        await m.answer("Неверный формат даты (нужно YYYY-MM-DD).")
-        return
-    sched = read_schedule_map()
-    wd = WEEKDAYS[dt.weekday()]
-    items = sched.get(group, {}).get(wd, [])
-    await m.answer(
-        f"<b>{WEEKDAYS_RU[wd]} ({dt:%d.%m.%Y})</b>\n{format_lessons(items)}",
-        parse_mode="HTML",
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
-
-# Exams
 def format_exams(items: List[Dict[str, Any]], title: str) -> str:
     if not items:
         return title + "\nНет запланированных контрольных."
@@ -549,61 +869,69 @@ def format_exams(items: List[Dict[str, Any]], title: str) -> str:
         t = f" — {x['time']}" if x.get("time") else ""
         note = f"\n   ⤷ {x['note']}" if x.get("note") else ""
         # date in UI: DD.MM.YYYY
-        ds = str(x.get("date") or "")
-        if not ds:
-            d = parse_exam_date(str(x.get("date_iso") or ""))
-            ds = d.strftime("%d.%m.%Y") if d else ""
+        ds = x.get("date_str") or x["date"].strftime("%d.%m.%Y")
         parts.append(f"{i}. {ds}{t}: {x['subject']}{note}")
     return "\n".join(parts)
 
+def _render_exams_upcoming(group: str) -> str:
+    today = now_local().date()
+    items = exams_for_range(read_exams_map().get(group, []), start=today, end=today + timedelta(days=90))
+    return format_exams(items, f"📌 Контрольные (ближайшие), группа {group}")
+
+def _render_exams_week(group: str, week_offset: int) -> str:
+    start = (monday_of_week(now_local()) + timedelta(days=7 * week_offset)).date()
+    items = exams_for_range(read_exams_map().get(group, []), start=start, end=start + timedelta(days=6))
+    label = "на неделю" if week_offset == 0 else "на след. неделю"
+    return format_exams(items, f"📅 Контрольные {label} ({week_range_str(start)}), группа {group}")
+
+# action -> (renderer(group), parse_mode)
+_VIEWS = {
+    "today": (lambda g: _render_day(g, 0), "HTML"),
+    "tomorrow": (lambda g: _render_day(g, 1), "HTML"),
+    "week": (lambda g: _render_week(g, 0), "HTML"),
+    "nextweek": (lambda g: _render_week(g, 1), "HTML"),
+    "exams": (_render_exams_upcoming, None),
+    "exams_week": (lambda g: _render_exams_week(g, 0), None),
+    "exams_nextweek": (lambda g: _render_exams_week(g, 1), None),
+}
 
-@router.message(Command("exams"))
-async def cmd_exams(m: Message, state: FSMContext):
-    group = await ensure_group(m, state)
-    if not group:
-        return
-    exmap = read_exams_map()
-    items = exams_for_range(
-        exmap.get(group, []),
-        start=now_local().date(),
-        end=now_local().date() + timedelta(days=90)
-    )
-    await m.answer(
-        format_exams(items, f"📌 Контрольные (ближайшие), группа {group}"),
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
+async def send_view(m: Message, uid: int, group: str, action: str):
+    render, parse_mode = _VIEWS[action]
+    await ensure_snapshots()
+    await m.answer(render(group), parse_mode=parse_mode, reply_markup=main_menu_kb(is_admin(uid)))
 
-@router.message(Command("exams_week"))
-async def cmd_exams_week(m: Message, state: FSMContext):
+@router.message(Command(*_VIEWS))
+async def cmd_view(m: Message, state: FSMContext, command: CommandObject):
     group = await ensure_group(m, state)
     if not group:
         return
-    exmap = read_exams_map()
-    start = monday_of_week(now_local()).date()
-    items = exams_for_range(exmap.get(group, []), start=start, end=start + timedelta(days=6))
-    await m.answer(
-        format_exams(items, f"📅 Контрольные на неделю ({week_range_str(start)}), группа {group}"),
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
+    await send_view(m, m.from_user.id, group, command.command)
 
-@router.message(Command("exams_nextweek"))
-async def cmd_exams_nextweek(m: Message, state: FSMContext):
+@router.message(Command("date"))
+async def cmd_date(m: Message, state: FSMContext):
     group = await ensure_group(m, state)
     if not group:
         return
-    exmap = read_exams_map()
-    start = (monday_of_week(now_local()) + timedelta(days=7)).date()
-    items = exams_for_range(exmap.get(group, []), start=start, end=start + timedelta(days=6))
-    await m.answer(
-        format_exams(items, f"📅 Контрольные на след. неделю ({week_range_str(start)}), группа {group}"),
-        reply_markup=main_menu_kb(is_admin(m.from_user.id))
-    )
+    parts = (m.text or "").split()
+    if len(parts) != 2:
+        await m.answer("Использование: /date YYYY-MM-DD")
+        return
+    try:
+        dt = datetime.strptime(parts[1], "%Y-%m-%d")
+    except ValueError:
+        await m.answer("Неверный формат даты (нужно YYYY-MM-DD).")
+        return
+    await ensure_snapshots()
+    await m.answer(render_date(group, dt), parse_mode="HTML", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
 
 # Menu callbacks
-@router.callback_query(F.data.startswith("menu:"))
+@router.callback_query(MENU_CB)
 async def on_menu(cq: CallbackQuery, state: FSMContext):
-    await ack(cq)
     data = await state.get_data()
+    action = cq.data.split(":", 1)[1]
+    # only a view with a group chosen may have to wait for Sheets
+    loads = action in _VIEWS and data.get("group") and not snapshots_ready()
+    await ack(cq, LOADING_TEXT if loads else None)
     if cq.data == "menu:change_group":
         await state.clear()
         await cq.message.answer("Выберите группу:", reply_markup=groups_kb())
@@ -614,58 +942,8 @@ async def on_menu(cq: CallbackQuery, state: FSMContext):
         await cq.message.answer("Сначала выберите группу:", reply_markup=groups_kb())
         return
 
-    action = cq.data.split(":", 1)[1]
-    if action in ("today", "tomorrow", "week", "nextweek"):
-        sched = read_schedule_map()
-        if action == "today":
-            dt = now_local()
-            wd = WEEKDAYS[dt.weekday()]
-            items = sched.get(group, {}).get(wd, [])
-            await cq.message.answer(f"<b>{WEEKDAYS_RU[wd]} ({dt:%d.%m.%Y})</b>\n{format_lessons(items)}", parse_mode="HTML", reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-            return
-        if action == "tomorrow":
-            dt = now_local() + timedelta(days=1)
-            wd = WEEKDAYS[dt.weekday()]
-            items = sched.get(group, {}).get(wd, [])
-            await cq.message.answer(f"<b>{WEEKDAYS_RU[wd]} ({dt:%d.%m.%Y})</b>\n{format_lessons(items)}", parse_mode="HTML", reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-            return
-        if action == "week":
-            start = monday_of_week(now_local())
-            d = start
-            chunks = []
-            for _ in range(7):
-                wd = WEEKDAYS[d.weekday()]
-                items = sched.get(group, {}).get(wd, [])
-                chunks.append(f"<b>{WEEKDAYS_RU[wd]} ({d:%d.%m})</b>\n{format_lessons(items)}")
-                d += timedelta(days=1)
-            await cq.message.answer("\n\n".join(chunks), parse_mode="HTML", reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-            return
-        if action == "nextweek":
-            start = monday_of_week(now_local()) + timedelta(days=7)
-            d = start
-            chunks = []
-            for _ in range(7):
-                wd = WEEKDAYS[d.weekday()]
-                items = sched.get(group, {}).get(wd, [])
-                chunks.append(f"<b>{WEEKDAYS_RU[wd]} ({d:%d.%m})</b>\n{format_lessons(items)}")
-                d += timedelta(days=1)
-            await cq.message.answer("\n\n".join(chunks), parse_mode="HTML", reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-            return
-
-    if action in ("exams", "exams_week", "exams_nextweek"):
-        exmap = read_exams_map()
-        ex = exmap.get(group, [])
-        if action == "exams":
-            items = exams_for_range(ex, start=now_local().date(), end=now_local().date() + timedelta(days=90))
-            await cq.message.answer(format_exams(items, f"📌 Контрольные (ближайшие), группа {group}"), reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-        elif action == "exams_week":
-            start = monday_of_week(now_local()).date()
-            items = exams_for_range(ex, start=start, end=start + timedelta(days=6))
-            await cq.message.answer(format_exams(items, f"📅 Контрольные на неделю ({week_range_str(start)}), группа {group}"), reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
-        else:
-            start = (monday_of_week(now_local()) + timedelta(days=7)).date()
-            items = exams_for_range(ex, start=start, end=start + timedelta(days=6))
-            await cq.message.answer(format_exams(items, f"📅 Контрольные на след. неделю ({week_range_str(start)}), группа {group}"), reply_markup=main_menu_kb(is_admin(cq.from_user.id)))
+    if action in _VIEWS:
+        await send_view(cq.message, cq.from_user.id, group, action)
 
 # Admin panel and broadcast
 @router.message(Command("admin"))
@@ -680,12 +958,15 @@ async def cmd_admin_info(m: Message):
     if not is_admin(m.from_user.id):
         await m.answer("Команда доступна только администраторам.")
         return
+    await send_admin_info(m)
+
+async def send_admin_info(m: Message):
     try:
-        cnt_sched = len(gs_read_all(GS_SCHEDULE_SHEET))
-        cnt_exams = len(gs_read_all(GS_EXAMS_SHEET))
-        ensure_subs_sheet_headers()
-        subs_ws = ws_open(GS_SUBS_SHEET)
-        subs = subs_ws.get_all_records()
+        await _gs(ensure_subs_sheet_headers)
+        raw = await _gs(gs_read_many, [GS_SCHEDULE_SHEET, GS_EXAMS_SHEET, GS_SUBS_SHEET])
+        cnt_sched = len(values_to_records(raw[GS_SCHEDULE_SHEET]))
+        cnt_exams = len(values_to_records(raw[GS_EXAMS_SHEET]))
+        subs = values_to_records(raw[GS_SUBS_SHEET])
         # count by groups
         counts = {g: sum(1 for r in subs if str(r.get("group")) == g) for g in GROUPS}
         parts = "\n".join(f"{g}={counts[g]}" for g in GROUPS)
@@ -701,13 +982,17 @@ async def cmd_admin_info(m: Message):
         await m.answer(f"Ошибка доступа к Google Sheets: {e!r}")
 
 @router.message(Command("admin_reload"))
-async def cmd_admin_reload(m: Message):
+async def cmd_admin_reload(m: Message, reload_event: Optional[asyncio.Event] = None):
     if not is_admin(m.from_user.id):
         await m.answer("Команда доступна только администраторам.")
         return
+    await do_admin_reload(m, reload_event)
+
+async def do_admin_reload(m: Message, reload_event: Optional[asyncio.Event] = None):
     try:
-        _ = read_schedule_map()
-        _ = read_exams_map()
+        await _gs(reload_all)
+        if reload_event is not None:
+            reload_event.set()  # let the watchdog diff the fresh data now
         await m.answer("✅ Данные перечитаны из Google Sheets (готово).")
     except Exception as e:
         await m.answer(f"❌ Ошибка при обновлении: {e!r}")
@@ -718,11 +1003,14 @@ async def cmd_broadcast(m: Message, state: FSMContext):
     if not is_admin(m.from_user.id):
         await m.answer("Команда доступна только администраторам.")
         return
+    await start_broadcast(m, state)
+
+async def start_broadcast(m: Message, state: FSMContext):
     await state.set_state(BroadcastFSM.wait_group)
     await state.update_data(broadcast_group=None, broadcast_text=None)
     await m.answer("Выберите, кому отправить объявление:", reply_markup=broadcast_pick_group_kb())
 
-@router.callback_query(F.data.startswith("broadcast:"))
+@router.callback_query(BROADCAST_CB)
 async def on_broadcast_flow(cq: CallbackQuery, state: FSMContext):
     await ack(cq)
     if not is_admin(cq.from_user.id):
@@ -742,7 +1030,7 @@ async def on_broadcast_flow(cq: CallbackQuery, state: FSMContext):
         await state.set_state(BroadcastFSM.wait_text)
         await state.update_data(broadcast_group=grp)
         await cq.message.answer(
-            f"Введите текст объявления для: {'+'.join(GROUPS) if grp=='both' else grp}\n\n"
+            f"Введите текст объявления для: {_ALL_GROUPS_LABEL if grp=='both' else grp}\n\n"
             "Отправьте одним сообщением. Для отмены — /cancel"
         )
 
@@ -766,14 +1054,10 @@ async def on_broadcast_text(m: Message, state: FSMContext, bot: Bot):
         await m.answer("Пустое сообщение. Введите текст или /cancel.")
         return
     try:
-        ensure_subs_sheet_headers()
-        ws = ws_open(GS_SUBS_SHEET)
-        subs = ws.get_all_records()
-        if grp in GROUPS:
-            targets = [int(r["user_id"]) for r in subs if str(r.get("group")) == grp]
-        else:
-            targets = [int(r["user_id"]) for r in subs if str(r.get("group")) in GROUPS]
-        targets = sorted(set(targets))
+        await _gs(ensure_subs_sheet_headers)
+        subs_by_group = await _gs(get_subs_by_group)
+        # grp is a group or "both"; the index is already de-duplicated
+        targets = subs_by_group.get(grp, [])
     except Exception as e:
         await state.clear()
         await m.answer(f"❌ Ошибка чтения подписчиков: {e!r}")
@@ -782,97 +1066,186 @@ async def on_broadcast_text(m: Message, state: FSMContext, bot: Bot):
         await state.clear()
         await m.answer("Подписчиков не найдено для выбранной группы.")
         return
-    ok, fail = 0, 0
-    for uid in targets:
-        try:
-            await bot.send_message(uid, f"📣 Объявление для группы {grp if grp!='both' else '+'.join(GROUPS)}:\n\n{text}")
-            ok += 1
-        except Exception as e:
-            log.warning("Не удалось отправить %s: %r", uid, e)
-            fail += 1
-            await asyncio.sleep(0.05)
+    # formatted once; every recipient gets the same string
+    header = f"📣 Объявление для группы {grp if grp != 'both' else _ALL_GROUPS_LABEL}:\n\n"
+    ok, fail = await send_many(bot, targets, header + text)
     await state.clear()
     await m.answer(f"Готово. Разослано: {ok}, ошибок: {fail}.")
 
-@router.callback_query(F.data.startswith("admin:"))
-async def on_admin_panel(cq: CallbackQuery, state: FSMContext):
-    await ack(cq)
-    if not is_admin(cq.from_user.id):
+# Admin panel buttons. cq.message is the bot's own message, so its from_user is the bot:
+# actions get the callback and call the command bodies directly, after the check in on_admin_panel.
+async def _show_panel(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    await cq.message.answer("⚙️ Админ-панель", reply_markup=admin_panel_kb())
+
+async def _panel_info(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    await send_admin_info(cq.message)
+
+async def _panel_reload(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    await do_admin_reload(cq.message, reload_event)
+
+async def _go_back(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    await cq.message.answer("Главное меню", reply_markup=main_menu_kb(True))
+
+async def _panel_broadcast(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    await start_broadcast(cq.message, state)
+
+_ADMIN_ACTIONS = {
+    "panel": _show_panel,
+    "info": _panel_info,
+    "reload": _panel_reload,
+    "back": _go_back,
+    "broadcast": _panel_broadcast,
+}
+
+@router.callback_query(ADMIN_CB)
+async def on_admin_panel(cq: CallbackQuery, state: FSMContext, reload_event: asyncio.Event):
+    admin = is_admin(cq.from_user.id)
+    await ack(cq, LOADING_TEXT if admin and cq.data in ("admin:info", "admin:reload") else None)
+    if not admin:
         await cq.message.answer("Только для администраторов.")
         return
-    action = cq.data.split(":")[1]
-    if action == "panel":
-        await cq.message.answer("⚙️ Админ-панель", reply_markup=admin_panel_kb())
-    elif action == "info":
-        await cmd_admin_info(cq.message)
-    elif action == "reload":
-        await cmd_admin_reload(cq.message)
-    elif action == "back":
-        data = await state.get_data()
-        isadm = is_admin(cq.from_user.id)
-        await cq.message.answer("Главное меню", reply_markup=main_menu_kb(isadm))
-    elif action == "broadcast":
-        await cmd_broadcast(cq.message, state)
+    handler = _ADMIN_ACTIONS.get(cq.data.split(":")[1])
+    if handler:
+        await handler(cq, state, reload_event)
 
 # -------------------- Auto-notify about changes --------------------
-def hash_group_data_for_changes(sched_map: Dict[str, Dict[str, List[Dict[str, Any]]]],
+# Group fingerprint = sum of 128-bit per-row digests (mod 2**128): a multiset hash, so
+# it doesn't depend on row order and one changed row only swaps one term. A sum rather
+# than XOR keeps two identical rows from cancelling each other out.
+_DIGEST_MASK = (1 << 128) - 1
+
+def hash_group_data_for_changes(sched_map: ScheduleMap,
                                 exams_map: Dict[str, List[Dict[str, Any]]],
                                 group: str) -> str:
-    payload = {
-        "schedule": sched_map.get(group, {}),
-        "exams": exams_map.get(group, []),
-    }
-    blob = json.dumps(payload, ensure_ascii=False, sort_keys=True)
-    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    # digests were computed once when the rows were interned
+    acc = 0
+    for wd in WEEKDAYS:
+        for item in sched_map.get((group, wd), ()):
+            acc += item.digest
+    for item in exams_map.get(group, []):
+        acc += item.digest
+    return f"{acc & _DIGEST_MASK:032x}"
 
 async def notify_subscribers(bot: Bot, group: str, text: str):
     try:
-        ensure_subs_sheet_headers()
-        ws = ws_open(GS_SUBS_SHEET)
-        subs = ws.get_all_records()
-        targets = [int(r["user_id"]) for r in subs if str(r.get("group")) == group]
+        await _gs(ensure_subs_sheet_headers)
+        targets = (await _gs(get_subs_by_group)).get(group)
         if not targets:
             return
-        for uid in sorted(set(targets)):
-            try:
-                await bot.send_message(uid, text)
-            except Exception as e:
-                log.warning("Notify %s failed: %r", uid, e)
-                await asyncio.sleep(0.05)
+        ok, fail = await send_many(bot, targets, text)
+        log.info("Notified group %s: ok=%s, failed=%s", group, ok, fail)
     except Exception as e:
         log.error("notify_subscribers error: %r", e)
 
-async def watch_changes(bot: Bot, stop_event: asyncio.Event):
-    # store last hashes by group
-    last_hash: Dict[str, str] = {}
-    # init
+def load_watch_state() -> Dict[str, str]:
     try:
-        sched = read_schedule_map()
-        exams = read_exams_map()
-        for g in GROUPS:
-            last_hash[g] = hash_group_data_for_changes(sched, exams, g)
+        with open(WATCH_STATE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        return {str(g): str(h) for g, h in data.items()}
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        log.warning("Initial read of Google Sheets failed: %r", e)
+        log.warning("Cannot read %s: %r", WATCH_STATE_PATH, e)
+        return {}
+
+def save_watch_state(hashes: Dict[str, str]):
+    tmp = WATCH_STATE_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(hashes, f)
+        os.replace(tmp, WATCH_STATE_PATH)  # atomic: a crash never leaves a half-written file
+    except Exception as e:
+        log.warning("Cannot write %s: %r", WATCH_STATE_PATH, e)
+
+async def watch_changes(bot: Bot, stop_event: asyncio.Event, reload_event: asyncio.Event):
+    # hashes last seen / last notified (persisted) by group; they differ only while a
+    # notification is pending, so a restart in the debounce window still notifies
+    saved_hash = {g: h for g, h in load_watch_state().items() if g in _GROUPS_SET}
+    last_hash: Dict[str, str] = dict(saved_hash)
+    # init only groups without a saved fingerprint (snapshots are normally prefetched in main);
+    # with a saved state the first poll reports whatever changed while the bot was down
+    if len(last_hash) < len(GROUPS):
+        try:
+            sched, exams = await _gs(lambda: (read_schedule_map(), read_exams_map()))
+            for g in GROUPS:
+                last_hash.setdefault(g, hash_group_data_for_changes(sched, exams, g))
+            saved_hash = dict(last_hash)
+            save_watch_state(saved_hash)
+        except Exception as e:
+            log.warning("Initial read of Google Sheets failed: %r", e)
 
-    log.info("Watchdog started, interval=%ss", WATCH_INTERVAL)
+    log.info("Watchdog started, interval=%ss (max %ss)", WATCH_INTERVAL, WATCH_MAX_INTERVAL)
 
+    # debounce: group -> notify deadline / time of the first change in the current burst
+    pending_notify: Dict[str, float] = {}
+    first_change: Dict[str, float] = {}
+    interval = WATCH_INTERVAL
+    next_poll = time.monotonic() + interval
     while not stop_event.is_set():
         try:
-            await asyncio.sleep(WATCH_INTERVAL)
-            sched = read_schedule_map()
-            exams = read_exams_map()
-            for g in GROUPS:
-                cur = hash_group_data_for_changes(sched, exams, g)
-                if last_hash.get(g) and last_hash[g] != cur:
-                    last_hash[g] = cur
+            wake_at = min([next_poll, *pending_notify.values()])
+            try:
+                await asyncio.wait_for(reload_event.wait(), timeout=max(0.0, wake_at - time.monotonic()))
+                reload_event.clear()
+                forced = True
+            except asyncio.TimeoutError:
+                forced = False
+            if stop_event.is_set():
+                break
+            now = time.monotonic()
+            if forced or now >= next_poll:
+                next_poll = now + interval
+                if forced:
+                    # /admin_reload has just refreshed the snapshots (and the subs index)
+                    sched, exams = await _gs(lambda: (read_schedule_map(), read_exams_map()))
+                    subs = subs_last_index()
+                elif has_subscribers(subs_last_index()):
+                    # one values.batchGet for all sheets; also refreshes the handlers' snapshots
+                    # and the subs index
+                    sched, exams = await _gs(refresh_all)
+                    subs = subs_last_index()
+                else:
+                    # nobody was subscribed: only re-check the small subs sheet
+                    subs = await _gs(get_subs_by_group)
+                    sched, exams = await _gs(refresh_all) if has_subscribers(subs) else (None, None)
+                changed = False
+                for g in GROUPS:
+                    if not subs.get(g):
+                        # not watched; a later first subscriber starts from a fresh fingerprint
+                        last_hash.pop(g, None)
+                        pending_notify.pop(g, None)
+                        first_change.pop(g, None)
+                        if saved_hash.pop(g, None) is not None:
+                            save_watch_state(saved_hash)
+                        continue
+                    cur = hash_group_data_for_changes(sched, exams, g)
+                    if last_hash.get(g) and last_hash[g] != cur:
+                        changed = True
+                        last_hash[g] = cur
+                        first = first_change.setdefault(g, now)
+                        pending_notify[g] = min(now + NOTIFY_DEBOUNCE, first + NOTIFY_DEBOUNCE_MAX)
+                    elif g not in last_hash:
+                        last_hash[g] = cur
+                        saved_hash[g] = cur
+                        save_watch_state(saved_hash)
+                # back off during quiet periods, poll at full rate again after a change or reload
+                interval = WATCH_INTERVAL if changed or forced else min(interval * 2, WATCH_MAX_INTERVAL)
+                next_poll = now + interval
+            # one coalesced notification per group once its debounce window is over
+            for g, deadline in list(pending_notify.items()):
+                if now >= deadline:
+                    del pending_notify[g]
+                    first_change.pop(g, None)
+                    if last_hash.get(g) == saved_hash.get(g):
+                        continue  # the burst cancelled out (A -> B -> A): nothing to report
                     msg = (
                         f"🔔 Обновления в расписании для группы {g}\n"
                         f"• Время: {now_local():%d.%m.%Y %H:%M}\n"
                         f"Откройте меню бота: /today /week /exams"
                     )
                     await notify_subscribers(bot, g, msg)
-                elif g not in last_hash:
-                    last_hash[g] = cur
+                    saved_hash[g] = last_hash[g]
+                    save_watch_state(saved_hash)
         except Exception as e:
             log.error("watch_changes loop error: %r", e)
 
@@ -907,7 +1280,7 @@ async def main():
         log.warning("Google Sheets credentials not provided (GOOGLE_CREDS_JSON_PATH or GOOGLE_CREDS_JSON_CONTENT).")
 
     bot = Bot(BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=make_fsm_storage())
     dp.include_router(router)
 
     await bot.set_my_commands(GENERAL_CMDS, scope=BotCommandScopeDefault())
@@ -915,23 +1288,35 @@ async def main():
 
     # ensure subs sheet header exists
     try:
-        ensure_subs_sheet_headers()
+        await _gs(ensure_subs_sheet_headers)
     except Exception as e:
         log.warning("Could not verify/create subs sheet headers: %r", e)
 
+    # prefetch schedule/exams so the first requests don't hit Sheets
+    try:
+        await _gs(refresh_all)
+    except Exception as e:
+        log.warning("Initial read of Google Sheets failed: %r", e)
+
     # start watcher task
     stop_event = asyncio.Event()
-    watcher_task = asyncio.create_task(watch_changes(bot, stop_event))
+    reload_event = asyncio.Event()
+    dp["reload_event"] = reload_event  # injected into handlers that accept it
+    watcher_task = asyncio.create_task(watch_changes(bot, stop_event, reload_event))
 
     log.info("Bot started. TZ=%s | GSheet=%s [schedule=%s, exams=%s, subs=%s]",
              TZ_NAME, SPREADSHEET_ID, GS_SCHEDULE_SHEET, GS_EXAMS_SHEET, GS_SUBS_SHEET)
 
     try:
-        await dp.start_polling(bot, allowed_updates=["message", "callback_query"], skip_updates=True)
+        # pending updates are already dropped by delete_webhook above
+        await dp.start_polling(bot, allowed_updates=["message", "callback_query"],
+                               polling_timeout=POLLING_TIMEOUT)
     finally:
         stop_event.set()
+        reload_event.set()  # wake the watcher so it can exit
         with contextlib.suppress(Exception):
             await watcher_task
+        _gs_executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     try: